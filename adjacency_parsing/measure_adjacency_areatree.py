@@ -18,10 +18,14 @@ Parameters:
     -s, --scale_bounding_box (float): Scales the bounding box. Set to greater than 1
                 to ensure that all adjacent boundaries are identified in the preprocessing
                 step of looking for overlapping boundary boxes. (default is 1.1)
-    -n, --nprox (int): Number of CPU(s) used to process each layer. (default is 1)
+    -n, --nprox (int): Number of CPU(s) used to process each layer. (default is
+                the number of CPUs available to the process)
     -l, --layers (str): Specify which layers to process. Separate multiple layers
                  by a ','. Make sure to use the layer names in the trakem2 file. 
                  If not specified, then all layers will be processed. 
+    --no_cache: Do not read or write the parsed TrakEM2 cache, trakem2.cache.npz.
+                 By default the cache is written on the first run and reused
+                 while it is newer than the trakem2 file.
 
 
 Examples:
@@ -38,10 +42,12 @@ Examples:
 """
 import sys
 import os
+import shutil
+import tempfile
 import argparse
-import multiprocessing_on_dill as mp
-from multiprocessing import Pool
+from multiprocessing import get_all_start_methods, get_context
 import time
+from datetime import timedelta
 from lxml import etree
 import itertools
 
@@ -54,30 +60,92 @@ def process_overlap(o, P):
     return P.batch_compute_adjacency(o, pixel_radius=params.pixel_radius)
 
 
-def process_layer(l, P, params):
+def layer_overlaps(l, P, params):
     print(f'Processing layer: {l}')
-    parser = etree.XMLParser(remove_blank_text=True, huge_tree=True, recover=True)
-    P.xml = etree.parse(P.trakem2, parser)
     B = P.get_boundaries_in_layer(l, area_thresh=params.area_thresh,
                                   scale_bounding_box=params.scale_bounding_box)
-    overlap = P.get_overlapping_boundaries(B)
-    adj = P.batch_compute_adjacency(overlap, pixel_radius=params.pixel_radius)
-    return adj
+    return P.get_overlapping_boundaries(B)
 
+def process_layer(l, P, params):
+    overlap = layer_overlaps(l, P, params)
+    adj = P.batch_compute_adjacency(overlap, pixel_radius=params.pixel_radius)
+    return summarize(adj)
+
+def summarize(adj):
+    #Only names and indices are sent back to the parent, not the boundaries
+    return [(b1.name, b1.index, b2.name, b2.index, int(_adj))
+            for (b1,b2,_adj) in adj]
+
+_P = None
+_PARAMS = None
+
+def _init_worker(P, params):
+    #Installs the parsed TrakEM2 file once per worker, so only the
+    #layer name is sent with each task
+    global _P, _PARAMS
+    _P = P
+    _PARAMS = params
+
+def _process_layer(task):
+    l, fname = task
+    adj = process_layer(l, _P, _PARAMS)
+    write_layer(fname, l, adj)
+    return l, fname, len(adj)
+
+def _process_pairs(o):
+    return submit_batch(_P, o, _PARAMS.pixel_radius)
+
+def write_layer(fname, l, adj):
+    """Writes the adjacencies of layer l as a <layer> element to fname"""
+    with etree.xmlfile(fname, encoding='utf-8') as xf:
+        with xf.element('layer', name=l):
+            for (name1,index1,name2,index2,_adj) in adj:
+                with xf.element('area'):
+                    for (tag, text) in (('cell1', name1), ('cell2', name2),
+                                        ('index1', str(index1)),
+                                        ('index2', str(index2)),
+                                        ('adjacency', str(_adj))):
+                        with xf.element(tag):
+                            xf.write(text)
+
+def iter_layers(tasks, P, params):
+    """
+    Writes each (layer, file) task to its file and yields 
+    (layer, file, number of adjacencies) as soon as the layer is processed
+    """
+    chunksize = max(1, len(tasks) // (params.nproc + 2))
+    #forkserver starts workers from a clean process rather than forking
+    #the parent with its lxml state
+    method = 'forkserver' if 'forkserver' in get_all_start_methods() else None
+    ctx = get_context(method)
+    with ctx.Pool(processes=params.nproc, initializer=_init_worker,
+                  initargs=(P, params)) as pool:
+        if len(tasks) >= params.nproc:
+            yield from pool.imap_unordered(_process_layer, tasks, chunksize=chunksize)
+            return
+        #Too few layers to keep every worker busy, so split the
+        #overlapping boundaries of each layer across the workers
+        for l, fname in tasks:
+            overlap = layer_overlaps(l, P, params)
+            size = max(1, -(-len(overlap) // (params.nproc * 4)))
+            chunks = [overlap[i:i + size] for i in range(0, len(overlap), size)]
+            partials = pool.map(_process_pairs, chunks)
+            adj = list(itertools.chain.from_iterable(partials))
+            write_layer(fname, l, adj)
+            yield l, fname, len(adj)
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
 
 def time_string(_seconds):
-    day = _seconds // (24 * 3600)
-    _seconds = _seconds % (24 * 3600)
-    hour = _seconds // 3600
-    _seconds %= 3600
-    minutes = _seconds // 60
-    _seconds %= 60
-    seconds = _seconds
-    return "%d:%d:%d:%d" % (day, hour, minutes, seconds)
+    return str(timedelta(seconds=int(_seconds)))
 
 def submit_batch(P,o,pixel_radius):
     adj = P.batch_compute_adjacency(o,pixel_radius)
-    return adj
+    return summarize(adj)
     
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
@@ -123,10 +191,11 @@ if __name__ == '__main__':
                         dest = 'nproc',
                         action = 'store',
                         required = False,
-                        default = 1,
+                        default = available_cpus(),
                         type = int,
                         help = ("Number of jobs if running "
-                                "in multiprocessor mode. DEFAULT = 1.")
+                                "in multiprocessor mode. DEFAULT = number "
+                                "of available CPUs.")
                         )
     
     parser.add_argument('-l','--layers',
@@ -139,6 +208,13 @@ if __name__ == '__main__':
                                 "Must use layer name specified in "
                                 "//t2_patch/@title in TrakEM2 file."))
 
+    parser.add_argument('--no_cache',
+                        dest = 'no_cache',
+                        action = 'store_true',
+                        required = False,
+                        help = ("Do not read or write the parsed TrakEM2 "
+                                "cache (trakem2.cache.npz)."))
+
     
     params = parser.parse_args()
 
@@ -146,7 +222,8 @@ if __name__ == '__main__':
     print('Writing to file: %s' %params.fout)
     print('Running %d jobs' %params.nproc) 
     print('Loading TrakEM2 file...')
-    P = ParseTrakEM2(params.trakem2)
+    cache = None if params.no_cache else params.trakem2 + '.cache.npz'
+    P = ParseTrakEM2(params.trakem2, cache=cache)
     P.get_layers()
     layers_list = [f"'{layer}'" for layer in P.layers]
 
@@ -165,29 +242,30 @@ if __name__ == '__main__':
         layers = sorted(P.layers.keys())
     
 
-    #Set up xml if file if it does not exist
-    if not os.path.isfile(params.fout):
-        data = etree.Element('data')
-        xml_out = etree.tostring(data,pretty_print=False)
-        with open(params.fout,'wb') as fout:
-            fout.write(xml_out)
-            
-    #Open xml file
-    tree = etree.parse(params.fout)
-    root = tree.getroot()
-
-    #Add layers not previously analyzed
-    curr_layers = [l.get('name') for l in root.findall('layer')]
-    for l in layers:
-        if l in curr_layers:
-            xlayer = root.find("layer[@name='%s']" %l)
-            root.remove(xlayer)
-        _l = etree.SubElement(root,'layer')
-        _l.set('name',l)
-        root.append(_l) 
-    xml_out = etree.tostring(tree,pretty_print=False)
-    with open(params.fout,'wb') as fout:
-            fout.write(xml_out)
+    #Keep layers from a previous run that are not re-analyzed. Files left
+    #unclosed by older versions of this script are read with recover,
+    #anything that is not a <data> file is left untouched.
+    previous = []
+    stale = {}
+    if os.path.isfile(params.fout):
+        try:
+            parser = etree.XMLParser(remove_blank_text=True)
+            root = etree.parse(params.fout, parser).getroot()
+        except etree.XMLSyntaxError as e:
+            print('Warning: %s is not well formed (%s), recovering the '
+                  'layers that can be read.' %(params.fout, e))
+            parser = etree.XMLParser(remove_blank_text=True, recover=True)
+            root = etree.parse(params.fout, parser).getroot()
+        if root is None or root.tag != 'data':
+            sys.exit('%s is not an adjacency xml file, not overwriting it.'
+                     %params.fout)
+        curr_layers = {l.get('name'): l for l in root.iterfind('layer')}
+        for l in layers:
+            xlayer = curr_layers.pop(l, None)
+            if xlayer is not None:
+                root.remove(xlayer)
+                stale[l] = xlayer
+        previous = root.findall('layer')
 
 
     print('Processing layers...')
@@ -196,42 +274,46 @@ if __name__ == '__main__':
     idx = 0
     __end = '\r'
     time0 = time.time()
-    
-    if params.nproc == 1:
-        adjacencies = [process_layer(l, P) for l in layers]
-    else:
-        time1 = time.time()
-        with Pool(processes=params.nproc) as pool:
-            adjacencies = pool.starmap(process_layer, [(l, P, params) for l in layers])
-
-    for l, adj in zip(layers, adjacencies):
-        xlayer = root.find("layer[@name='%s']" %l)
-        print(idx)
-        for (b1,b2,_adj) in adj:
-            xarea = etree.SubElement(xlayer,'area')
-            cell1 = etree.SubElement(xarea,'cell1')
-            cell1.text = b1.name
-            cell2 = etree.SubElement(xarea,'cell2')
-            cell2.text = b2.name
-            idx1 = etree.SubElement(xarea,'index1')
-            idx1.text = str(b1.index)
-            idx2 = etree.SubElement(xarea,'index2')
-            idx2.text = str(b2.index)     
-            xadj = etree.SubElement(xarea,'adjacency')
-            xadj.text = str(_adj)             
-            
-        idx += 1
-        if idx == N: __end = '\n'
-        proc_time = time_string(time.time() - time0)
-        print("Processed %d/%d layers. Last layer processed: %s. "
-              "Found %d adjacencies. " 
-              "Time to process last layer: %2.3f sec. "
-              "Total processing time: %s. "
-              %(idx,N,l,len(adj),time.time() - time1,proc_time),end=__end)
-    
-        xml_out = etree.tostring(tree,pretty_print=False)
-        with open(params.fout,'wb') as fout:
-            fout.write(xml_out)
+    time1 = time.time()
+
+    #Each layer is written to its own file in tmpdir as it is processed,
+    #the files are joined into the xml file at the end. Layers finished
+    #before a failure are still joined, unfinished layers keep their
+    #result from the previous run.
+    tmpdir = tempfile.mkdtemp(prefix='layers_',
+                              dir=os.path.dirname(os.path.abspath(params.fout)))
+    tasks = [(l, os.path.join(tmpdir, '%d.xml' %i)) for (i,l) in enumerate(layers)]
+    done = {}
+    try:
+        for l, fname, nadj in iter_layers(tasks, P, params):
+            done[l] = fname
+            print(idx)
+            idx += 1
+            if idx == N: __end = '\n'
+            proc_time = time_string(time.time() - time0)
+            print("Processed %d/%d layers. Last layer processed: %s. "
+                  "Found %d adjacencies. " 
+                  "Time to process last layer: %2.3f sec. "
+                  "Total processing time: %s. "
+                  %(idx,N,l,nadj,time.time() - time1,proc_time),end=__end)
+            time1 = time.time()
+    finally:
+        try:
+            #Replace the xml file only once it is complete
+            with open(params.fout + '.tmp', 'wb') as fout:
+                fout.write(b"<?xml version='1.0' encoding='utf-8'?>\n<data>")
+                for xlayer in previous:
+                    fout.write(etree.tostring(xlayer, encoding='utf-8', with_tail=False))
+                for l, fname in tasks:
+                    if l in done:
+                        with open(fname, 'rb') as fin:
+                            shutil.copyfileobj(fin, fout)
+                    elif l in stale:
+                        fout.write(etree.tostring(stale[l], encoding='utf-8', with_tail=False))
+                fout.write(b'</data>')
+            os.replace(params.fout + '.tmp', params.fout)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            if os.path.exists(params.fout + '.tmp'):
+                os.remove(params.fout + '.tmp')
     print('Finished!')
-
-
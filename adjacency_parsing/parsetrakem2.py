@@ -17,8 +17,29 @@ Author: Christopher Brittin
 """
 import lxml.etree as etree
 import itertools
+import json
+import os
+import zipfile
 import numpy as np
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
+
+#Bumped whenever the parsed paths stored in the cache change
+CACHE_FORMAT = 2
+
+def parse_path(path):
+    """
+    Returns the points of a //t2_path/@d string 'M x y L x y ... z'
+    as an (n,2) array
+
+    Tokens are handled as in the original path_transform loop: each
+    ' L ' separated chunk contributes its first (x,y) only. For a path
+    with several subpaths, 'M 1 2 L 3 4 z M 10 20 L 30 40 z', the first
+    point of each later subpath is therefore dropped (3 points, not 4).
+    This is kept so adjacency results match earlier runs.
+    """
+    path = path.replace('M ','').replace(' z','').split(' L ')
+    return np.array([list(map(float,p.split(' ')))[:2] for p in path],
+                    dtype=float).reshape(-1,2)
 
 class ParseTrakEM2(object):
     """
@@ -30,8 +51,10 @@ class ParseTrakEM2(object):
     ---------
     trakem2 : str
        path to trakem2 file
-    xml : etree.parse
-       Parsed object for trakem2 file
+    paths : dictionary
+       Dictionary of area tree paths,
+       (key=(cell name,layer oid), value = list of //t2_path/@d, or
+       of parsed paths when loaded from a cache)
     layers : dictionary
        Dictionalary of layer objects,
        (key=layer name,value=Layer(object))
@@ -45,6 +68,15 @@ class ParseTrakEM2(object):
 
     Methods
     -------
+    iterparse()
+      Streams the trakem2 file and indexes the data used by the get_* methods
+
+    save_cache(cache)
+      Writes the indexed trakem2 data to a .npz file, replacing it atomically
+
+    load_cache(cache)
+      Reads the indexed trakem2 data from a .npz file
+
     get_layers()
       Assigns dictionary of Layer(objects) to self.layers
 
@@ -75,35 +107,150 @@ class ParseTrakEM2(object):
     """
 
     
-    def __init__(self,trakem2):
+    def __init__(self,trakem2,cache=None):
         """
         Parameters:
         ----------
         trakem2 : str
            path to trakem2 file
+        cache : str
+           path to a cache of the parsed trakem2 file. Loaded if it is
+           newer than the trakem2 file, otherwise written after parsing.
+           (default is None, no cache)
         """
         
         self.trakem2 = trakem2
-        parser = etree.XMLParser(remove_blank_text=True,huge_tree=True)
-        self.xml = etree.parse(trakem2,parser)
         self.layers = None
         self.area_list = None
         self.dx = 0
         self.dy = 0
+        if (cache and os.path.isfile(cache) and
+                os.path.getmtime(cache) >= os.path.getmtime(trakem2)):
+            try:
+                self.load_cache(cache)
+                return
+            except (zipfile.BadZipFile,EOFError,KeyError,ValueError,OSError) as e:
+                print('Could not read cache %s (%s), re-parsing.' %(cache,e))
+        self.iterparse()
+        if cache:
+            try:
+                self.save_cache(cache)
+            except OSError as e:
+                print('Could not write cache %s (%s).' %(cache,e))
 		
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        # Remove the unpicklable entries.
-        del state['xml']
-        return state
-
-    def __setstate__(self, state):
-        # Restore instance attributes.
-        self.__dict__.update(state)
-        # Restore the unpicklable entries.
-        parser = etree.XMLParser(remove_blank_text=True, huge_tree=True)
-        self.xml = etree.parse(self.trakem2, parser)
+    def iterparse(self):
+        """
+        Streams the trakem2 file once and indexes the attributes and
+        area tree paths used by the get_* methods. Elements are cleared
+        as soon as they are read, so memory does not scale with the
+        size of the trakem2 file.
+        """
+        self.layer_set = {}
+        self.calibration = {}
+        self.layer_attrs = []
+        self.patch_attrs = []
+        self.area_list_attrs = []
+        self.connector_attrs = []
+        self.paths = {}
+        area_tree = None
+        context = etree.iterparse(self.trakem2,events=('start','end'),
+                                  remove_blank_text=True,huge_tree=True,
+                                  recover=True)
+        for (event,elem) in context:
+            tag = elem.tag
+            if event == 'start':
+                if tag == 't2_layer_set' and not self.layer_set:
+                    self.layer_set = dict(elem.attrib)
+                elif tag == 't2_areatree':
+                    area_tree = elem.get('title')
+                continue
+            if tag == 't2_layer':
+                self.layer_attrs.append(dict(elem.attrib))
+            elif tag == 't2_patch':
+                self.patch_attrs.append(dict(elem.attrib))
+            elif tag == 't2_areatree':
+                self.area_list_attrs.append(dict(elem.attrib))
+                area_tree = None
+            elif tag == 't2_path' and area_tree is not None:
+                #t2_node[@lid]/t2_area/t2_path[@d]
+                node = elem.getparent().getparent()
+                d = elem.get('d')
+                if node is not None and node.tag == 't2_node' and d is not None:
+                    key = (area_tree,node.get('lid'))
+                    self.paths.setdefault(key,[]).append(d)
+            elif tag == 't2_connector':
+                self.connector_attrs.append(dict(elem.attrib))
+            elif tag == 't2_calibration' and not self.calibration:
+                self.calibration = dict(elem.attrib)
+            #Free elements that have already been read. The root has no
+            #parent, but may follow top-level comments or PIs.
+            elem.clear()
+            parent = elem.getparent()
+            if parent is None: continue
+            while elem.getprevious() is not None:
+                del parent[0]
+        del context
 			
+    def save_cache(self,cache):
+        """
+        Writes the indexed trakem2 data to a .npz file. Paths are stored
+        parsed, as one array of points with the number of points and
+        the (cell name,layer oid) key of each path.
+
+        Parameters
+        ----------
+        cache : str
+          path to the .npz file
+        """
+        keys = [k for k in self.paths if None not in k]
+        paths = [[parse_path(d) for d in self.paths[k]] for k in keys]
+        key = np.repeat(np.arange(len(keys)),[len(p) for p in paths])
+        paths = list(itertools.chain.from_iterable(paths))
+        meta = {'format':CACHE_FORMAT,
+                'layer_set':self.layer_set,
+                'calibration':self.calibration,
+                'layer_attrs':self.layer_attrs,
+                'patch_attrs':self.patch_attrs,
+                'area_list_attrs':self.area_list_attrs,
+                'connector_attrs':self.connector_attrs}
+        #Written to a temporary file first so an interrupted write never
+        #leaves a partial cache in place
+        tmp = cache + '.tmp'
+        try:
+            with open(tmp,'wb') as fout:
+                np.savez_compressed(fout,
+                                    meta=np.array(json.dumps(meta)),
+                                    names=np.array([k[0] for k in keys],dtype=str),
+                                    lids=np.array([k[1] for k in keys],dtype=str),
+                                    key=key,
+                                    count=np.array([len(p) for p in paths],dtype=int),
+                                    coords=np.concatenate(paths + [np.empty((0,2))]))
+            os.replace(tmp,cache)
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+
+    def load_cache(self,cache):
+        """
+        Reads the indexed trakem2 data written by save_cache()
+
+        Parameters
+        ----------
+        cache : str
+          path to the .npz file
+        """
+        with np.load(cache) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('format') != CACHE_FORMAT:
+                raise ValueError('cache format %s' %meta.get('format'))
+            for k in ('layer_set','calibration','layer_attrs','patch_attrs',
+                      'area_list_attrs','connector_attrs'):
+                setattr(self,k,meta[k])
+            keys = list(zip(data['names'].tolist(),data['lids'].tolist()))
+            paths = np.split(data['coords'],np.cumsum(data['count'])[:-1])
+            self.paths = {}
+            for (k,p) in zip(data['key'],paths):
+                self.paths.setdefault(keys[k],[]).append(p)
+
     def get_layers(self):
         """
         Assigns dictionary of Layer(objects) to self.layers
@@ -112,16 +259,16 @@ class ParseTrakEM2(object):
         (key=layer name, val=Layer(object))
         """
         
-        layer_width = self.xml.xpath("//t2_layer_set/@layer_width")[0]
-        layer_height = self.xml.xpath("//t2_layer_set/@layer_height")[0]
+        layer_width = self.layer_set['layer_width']
+        layer_height = self.layer_set['layer_height']
         self.layer_dim = [float(layer_width),float(layer_height)]        
-        oid = self.xml.xpath("//t2_layer/@oid")
-        thickness = self.xml.xpath("//t2_layer/@thickness")
-        z = self.xml.xpath("//t2_layer/@z")
-        title = self.xml.xpath("//t2_layer/@z")
-        trans = self.xml.xpath("//t2_patch/@transform")
-        width = self.xml.xpath("//t2_patch/@width")
-        height = self.xml.xpath("//t2_patch/@height")
+        oid = [a['oid'] for a in self.layer_attrs]
+        thickness = [a['thickness'] for a in self.layer_attrs]
+        z = [a['z'] for a in self.layer_attrs]
+        title = [a['z'] for a in self.layer_attrs]
+        trans = [a['transform'] for a in self.patch_attrs]
+        width = [a['width'] for a in self.patch_attrs]
+        height = [a['height'] for a in self.patch_attrs]
         self.layers = {}
         for i in range(len(oid)):
             temp = trans[i].split(',')
@@ -143,9 +290,9 @@ class ParseTrakEM2(object):
         self.area_lists is a dictionary 
         (key=cell name, val=AreaList(object))
         """
-        connectors = self.xml.xpath("//t2_connector/@title")
-        trans = self.xml.xpath("//t2_connector/@transform")
-        oid = self.xml.xpath("//t2_connector/@oid")
+        connectors = [a['title'] for a in self.connector_attrs]
+        trans = [a['transform'] for a in self.connector_attrs]
+        oid = [a['oid'] for a in self.connector_attrs]
         self.connectors = {}
         for i in range(len(connectors)):
             temp = trans[i].split(',')
@@ -171,8 +318,8 @@ class ParseTrakEM2(object):
         self.area_lists is a dictionary 
         (key=cell name, val=AreaList(object))
         """
-        area_lists = self.xml.xpath("//t2_areatree/@title")
-        trans = self.xml.xpath("//t2_areatree/@transform")
+        area_lists = [a['title'] for a in self.area_list_attrs]
+        trans = [a['transform'] for a in self.area_list_attrs]
         self.area_lists = {}
         for i in range(len(area_lists)):
             temp = trans[i].split(',')
@@ -190,10 +337,10 @@ class ParseTrakEM2(object):
    
         
     def get_calibration(self):
-        self.px_width = float(self.xml.xpath("//t2_calibration/@pixelWidth")[0])
-        self.px_height = float(self.xml.xpath("//t2_calibration/@pixelHeight")[0])
-        self.px_depth = float(self.xml.xpath("//t2_calibration/@pixelDepth")[0])
-        trans = self.xml.xpath("//t2_layer_set/@transform")[0]	
+        self.px_width = float(self.calibration['pixelWidth'])
+        self.px_height = float(self.calibration['pixelHeight'])
+        self.px_depth = float(self.calibration['pixelDepth'])
+        trans = self.layer_set['transform']	
         trans = trans.replace(')','')
         trans = trans.split(',')
         self.dx = float(trans[-2])
@@ -234,10 +381,7 @@ class ParseTrakEM2(object):
         if not area_lists: area_lists = self.area_lists.keys()
         boundary = {}
         for n in area_lists:
-            path = ("//t2_areatree[@title='%s']"
-                    "//t2_node[@lid='%s']"
-                    "/t2_area/t2_path/@d" %(n,layer.oid))
-            path = self.xml.xpath(path)
+            path = self.paths.get((n,layer.oid),[])
             temp,idx = {},0
             for p in path:
                 p = self.area_lists[n].path_transform(p)
@@ -246,6 +390,7 @@ class ParseTrakEM2(object):
                 if b.area > area_thresh:
                     b.fill_boundary_gaps()
                     b.set_bounding_box()
+                    b.set_points()
                     if scale_bounding_box != 1:
                         b.scale_bounding_box(scale_bounding_box)
                     temp[idx] = b
@@ -276,14 +421,70 @@ class ParseTrakEM2(object):
         """
         
         nlst = [n for n in boundaries if n not in ['Pharynx','Phi_Marker']]
-        comb = itertools.combinations(nlst,2)
-        overlaps = []
-        for (a,b) in comb:
-            for i in boundaries[a]:
-                for j in boundaries[b]:
-                    if self.is_boundary_overlap(boundaries[a][i],boundaries[b][j]):
-                        overlaps.append((boundaries[a][i],boundaries[b][j]))
-        return overlaps
+        B,cell,index = [],[],[]
+        for (k,n) in enumerate(nlst):
+            for i in boundaries[n]:
+                B.append(boundaries[n][i])
+                cell.append(k)
+                index.append(i)
+        cell,index = np.array(cell,dtype=int),np.array(index,dtype=int)
+        pairs = self._overlap_pairs_sweep(B)
+        #Only compare boundaries from different cells
+        pairs = pairs[cell[pairs[:,0]] != cell[pairs[:,1]]]
+        swap = cell[pairs[:,0]] > cell[pairs[:,1]]
+        pairs[swap] = pairs[swap][:,::-1]
+        #Keep the (cell1,cell2,index1,index2) ordering of the pairwise scan
+        p,q = pairs[:,0],pairs[:,1]
+        pairs = pairs[np.lexsort((index[q],index[p],cell[q],cell[p]))]
+        return [(B[p],B[q]) for (p,q) in pairs]
+
+    def _overlap_pairs_sweep(self,B,block=256):
+        """
+        Returns index pairs (i,j) of boundaries in B with overlapping
+        bounding boxes using a sweep along x. Boxes are sorted by
+        xmin, so box i only needs to be tested against the boxes
+        that start before xmax_i. The tests are done as broadcast
+        comparisons for blocks of boxes on integer coordinates.
+
+        Parameters
+        ----------
+        B : list
+          List of Boundary(objects)
+        block : int
+          Number of boxes tested per broadcast (default is 256)
+
+        Returns
+        ----------
+        pairs : numpy array
+          Array of shape (n,2) of indices into B of boundaries with
+          overlapping bounding boxes
+        """
+        n = len(B)
+        box = np.array([b.bounding_box for b in B],dtype=float).reshape(n,4)
+        #Bounding boxes are pixel coordinates, int16 holds canvases up
+        #to 32767 px and packs twice the lanes of float32
+        box = np.rint(box)
+        dtype = np.int16
+        if n and np.abs(box).max() > np.iinfo(np.int16).max: dtype = np.int32
+        box = box.astype(dtype)
+        mn,mx = box[:,:2],box[:,2:]
+        order = np.argsort(mn[:,0],kind='stable')
+        mn,mx = mn[order],mx[order]
+        end = np.searchsorted(mn[:,0],mx[:,0],side='right')
+        pairs = [np.empty((0,2),dtype=int)]
+        for r0 in range(0,n,block):
+            r1 = min(r0 + block,n)
+            c1 = end[r0:r1].max()
+            if c1 <= r0 + 1: continue
+            overlap = ~((mx[r0:r1,None,0] < mn[None,r0:c1,0]) |
+                        (mn[r0:r1,None,0] > mx[None,r0:c1,0]) |
+                        (mx[r0:r1,None,1] < mn[None,r0:c1,1]) |
+                        (mn[r0:r1,None,1] > mx[None,r0:c1,1]))
+            #Upper triangle only, each pair is reported once
+            overlap = np.triu(overlap,1)
+            (i,j) = overlap.nonzero()
+            pairs.append(np.stack((order[i + r0],order[j + r0]),axis=1))
+        return np.concatenate(pairs)
 
     def is_boundary_overlap(self,A,B):
         """
@@ -331,13 +532,63 @@ class ParseTrakEM2(object):
            of pixels in boundary B adjacent to A.  
         """
         
-        XA = np.array(A.path)
-        XB = np.array(B.path)
-        Y = cdist(XA,XB,'euclidean')
-        I = np.where(Y <= pixel_radius)
-        adj = min(len(set(I[0])),len(set(I[1])))
+        return self._compute_adjacency(self._index(A,pixel_radius),
+                                       self._index(B,pixel_radius),
+                                       pixel_radius)
+
+    def _compute_adjacency(self,IA,IB,pixel_radius):
+        """
+        Returns the length of adjacency (int) between two boundaries
+        from their point indexes, see _index().
+        """
+        (_,_,_,cA,rA,_),(_,_,_,cB,rB,_) = IA,IB
+        #Skip boundaries whose bounding circles are too far apart
+        if np.hypot(*(cA - cB)) > rA + rB + pixel_radius: return 0
+        lA = self._count_adjacent(IA[0],IB,pixel_radius)
+        if lA == 0: return 0
+        lB = self._count_adjacent(IB[0],IA,pixel_radius)
+        adj = min(lA,lB)
         return adj
 
+    def _index(self,A,pixel_radius):
+        """
+        Returns the points of boundary A, the extent of the points grown
+        by the pixel radius, the bounding circle and a KD-tree of the 
+        points.
+
+        Parameters
+        ----------
+        A : Boundary(object)
+        pixel_radius : int
+          Boundary points closer than the pixel radius are classified
+          as adjacent.
+
+        Returns
+        ----------
+        (X,lo,hi,center,radius,tree) : tuple
+          X is the (n,2) array of boundary points, lo and hi the (x,y)
+          corners of the grown extent, center and radius the bounding
+          circle and tree a cKDTree of X.
+        """
+        if A.points is None: A.set_points()
+        X = A.points
+        lo = X.min(0) - pixel_radius
+        hi = X.max(0) + pixel_radius
+        tree = cKDTree(X,balanced_tree=False,compact_nodes=False)
+        return X,lo,hi,A.center,A.radius,tree
+
+    def _count_adjacent(self,X,IB,pixel_radius):
+        """
+        Returns the number of points in X within the pixel radius of a
+        point in the indexed boundary IB. Repeated points in X are 
+        each counted.
+        """
+        (_,lo,hi,_,_,tree) = IB
+        X = X[((X >= lo) & (X <= hi)).all(1)]
+        if len(X) == 0: return 0
+        n = tree.query_ball_point(X,pixel_radius,return_length=True)
+        return int(np.count_nonzero(n))
+
     def batch_compute_adjacency(self,boundaries,pixel_radius=10):
         """
         Returns lenth of adjacencies for a list of bondary pairs
@@ -359,9 +610,15 @@ class ParseTrakEM2(object):
         
         
         """
+        #Each boundary is indexed once and reused for all of its pairs
+        indexes = {}
+        def index(b):
+            if id(b) not in indexes:
+                indexes[id(b)] = self._index(b,pixel_radius)
+            return indexes[id(b)]
         adj = []
         for (b1,b2) in boundaries:
-           a = self.compute_adjacency(b1,b2,pixel_radius=pixel_radius)
+           a = self._compute_adjacency(index(b1),index(b2),pixel_radius)
            if a > 0:
                adj.append((b1,b2,a))
         return adj
@@ -371,10 +628,7 @@ class ParseTrakEM2(object):
         layer = self.layers[L[l-1]]
         boundary = {}
         for n in list(self.area_lists.keys()):
-            path = ("//t2_areatree[@title='%s']"
-                    "//t2_node[@lid='%s']"
-                    "/t2_area/t2_path/@d" %(n,layer.oid))
-            path = self.xml.xpath(path)
+            path = self.paths.get((n,layer.oid),[])
             temp = []
             for p in path:
                 p = self.area_lists[n].path_transform(p)
@@ -589,23 +843,18 @@ class AreaList(object):
         
         Parameters
         ----------
-        path : Boundary(object).path
-          Boundary path
+        path : str or numpy array
+          //t2_path/@d or the (n,2) array returned by parse_path()
 
         Returns
         ---------
-        path : list
-          Return a tranformed boundary object path  
+        path : numpy array
+          Return a tranformed boundary object path as an (n,2) array
 
         """
         
-        path = path.replace('M ','')
-        path = path.replace(' z','')
-        path = path.split(' L ')
-        path = [list(map(float,p.split(' '))) for p in path]
-        path = [(p[0] + self.transform[0], p[1] + self.transform[1])
-                for p in path]
-        return path
+        if isinstance(path,str): path = parse_path(path)
+        return path + self.transform
 
 class Boundary(object):
     """
@@ -617,8 +866,8 @@ class Boundary(object):
      name of cell
     index : int
      index of cell boundary in the given layer
-    path : list of tuples
-     Path extracted from TrakEM2 file
+    path : numpy array
+     (n,2) array of the path extracted from TrakEM2 file
     transform : tuple
      Transform to be applied to path
     area : int
@@ -633,6 +882,12 @@ class Boundary(object):
      Width of bounding box
     height : int
      Height of bounding box
+    points : numpy array
+     (n,2) float32 array of the path
+    center : numpy array
+     Center of the bounding circle of the path
+    radius : float
+     Radius of the bounding circle of the path
 
     Methods
     ---------
@@ -648,6 +903,9 @@ class Boundary(object):
     set_bounding_box()
       Sets the bounding box parameters
 
+    set_points()
+      Caches the path as an array along with its bounding circle
+
     scale_bounding_box(scale)
       Scales the bounding box about the center
 
@@ -667,6 +925,7 @@ class Boundary(object):
         self.transform = (0,0)
         self.area = None
         self.cent = None
+        self.points = None
         if 'transform' in kwargs:
             self.transform = kwargs['transform']
 
@@ -678,9 +937,9 @@ class Boundary(object):
         Elegance DB coordinates
         """
         
-        cent = [list(t) for t in zip(*self.path)]
-        self.cent = [np.mean(cent[0]) - self.transform[0],
-                     np.mean(cent[1]) - self.transform[1]]
+        cent = np.mean(self.path,axis=0)
+        self.cent = [cent[0] - self.transform[0],
+                     cent[1] - self.transform[1]]
 
     def set_boundary_length(self):
         """
@@ -693,28 +952,31 @@ class Boundary(object):
         """
         Computes the area enclosed by the boundary       
         """
-        B = self.path
+        B = np.asarray(self.path,dtype=float)
         #Computes area of polygon defined by given boundary 'B'
-        area = 0	
-        idx = [(i,i-1) for i in range(len(B))]
-        for (i,j) in idx:
-            #Algorithm taken from http://alienryderflex.com/polygon_area
-            #temp = (B[j][0] + B[i][0])*(B[j][1] - B[i][1])
-            #Definition of area of polygon            
-            area += (B[i][0]*B[j][1] - B[j][0]*B[i][1])
+        #Algorithm taken from http://alienryderflex.com/polygon_area
+        Bj = np.roll(B,1,axis=0)
+        area = (B[:,0]*Bj[:,1] - Bj[:,0]*B[:,1]).sum()
         self.area =  0.5*abs(area) 
-   
 
     def set_bounding_box(self):
         """
         Sets the bounding box parameters
         """
-        x_coordinates, y_coordinates = zip(*self.path)
-        self.bounding_box = [(min(x_coordinates), min(y_coordinates)),
-                             (max(x_coordinates), max(y_coordinates))]
+        B = np.asarray(self.path)
+        self.bounding_box = [tuple(B.min(0).tolist()),tuple(B.max(0).tolist())]
         self.width = self.bounding_box[1][0] - self.bounding_box[0][0] + 1
         self.height = self.bounding_box[1][1] - self.bounding_box[0][1] + 1
 
+    def set_points(self):
+        """
+        Caches the path as a contiguous float32 array along with the
+        center and radius of a circle enclosing the path
+        """
+        self.points = np.ascontiguousarray(self.path,dtype=np.float32).reshape(-1,2)
+        self.center = self.points.mean(0,dtype=np.float64)
+        self.radius = np.sqrt(((self.points - self.center)**2).sum(1).max())
+
     def scale_bounding_box(self,scale):
         """
         Scales the bounding box about the center
@@ -741,27 +1003,23 @@ class Boundary(object):
         """
         Fills any gaps in the boundary path to make it continous
         """
-        zB = list(zip(self.path[:-1],self.path[1:]))
-        zB.append((self.path[-1],self.path[0]))
-        cnts = []
-        for (c1,c2) in zB:
-            c1,c2 = list(map(int,c1)),list(map(int,c2))
-            lr,ud = [],[]
-            cnts.append(tuple(c1))
-            #move left or right
-            if c1[1] > c2[1]:
-                lr = range(c2[1],c1[1] + 1)
-            elif c2[1] > c1[1]:
-                lr = range(c1[1],c2[1] + 1)
-            for y in lr:
-                cnts.append((c1[0],y))
-            #move up or down
-            if c1[0] > c2[0]:
-                ud = range(c2[0],c1[0] + 1)
-            elif c2[0] < c1[0]:
-                ud = range(c1[0],c2[0] + 1)
-            for x in ud:
-                cnts.append((x,c2[1]))
+        #Each segment (c1,c2) contributes c1, then the column of points
+        #between c1[1] and c2[1] at c1[0], then the row of points from
+        #c2[0] to c1[0] at c2[1] when moving left. Points are truncated
+        #to ints.
+        c1 = np.asarray(self.path,dtype=float).astype(int).reshape(-1,2)
+        c2 = np.roll(c1,-1,axis=0)
+        ny = np.where(c1[:,1] != c2[:,1],abs(c1[:,1] - c2[:,1]) + 1,0)
+        nx = np.where(c1[:,0] > c2[:,0],c1[:,0] - c2[:,0] + 1,0)
+        count = 1 + ny + nx
+        seg = np.repeat(np.arange(len(c1)),count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count,count)
+        ny,c1,c2 = ny[seg],c1[seg],c2[seg]
+        cnts = np.empty((len(seg),2),dtype=int)
+        cnts[:,0] = np.where(k <= ny,c1[:,0],c2[:,0] + k - 1 - ny)
+        cnts[:,1] = np.where(k == 0,c1[:,1],
+                             np.where(k <= ny,np.minimum(c1[:,1],c2[:,1]) + k - 1,
+                                      c2[:,1]))
         self.path = cnts
 
         
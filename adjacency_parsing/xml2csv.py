@@ -12,6 +12,10 @@ import argparse
 from lxml import etree
 import csv
 
+#Fields of an <area>, compiled once
+area_fields = [etree.XPath(f) for f in
+               ('cell1','cell2','index1','index2','adjacency')]
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=
                                      ("Measure adjaceny in segmented" 
@@ -28,17 +32,14 @@ if __name__ == '__main__':
 
     tree = etree.parse(params.xml)
     root = tree.getroot()
-    layers = sorted([l.get('name') for l in root.findall('layer')])
+    xlayers = {l.get('name'): l for l in root.iterfind('layer')}
+    layers = sorted(xlayers)
     data = []
     for _l in layers:
-        l = root.find("layer[@name='%s']" %_l)
+        l = xlayers[_l]
         areas = l.findall('area')
         for a in areas:
-            c1 = a.find('cell1').text
-            c2 = a.find('cell2').text
-            i1 = a.find('index1').text
-            i2 = a.find('index2').text
-            adj = a.find('adjacency').text
+            c1,c2,i1,i2,adj = [f(a)[0].text for f in area_fields]
             data.append([c1,c2,i1,i2,_l,adj])
     
 